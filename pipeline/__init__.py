@@ -1,98 +1,244 @@
 
+import os
+from functools import lru_cache
+from types import SimpleNamespace
+import h5py
 import numpy as np
-import scipy.signal as signal
+import scipy.io as sio
+import scipy.ndimage as ndimage
 
 
 # helper functions
-def get_trials(key, min_trial, max_trial, trial_type):
+def load_session_data(session_dir, fields):
+    # v7.3 files are HDF5, only the fields needed by the caller are read
+    if h5py.is_hdf5(session_dir):
+        return _read_h5_fields(session_dir, fields)
+
+    # older files are parsed whole; the last parsed file is cached, tables
+    # imported from the same session file one after the other only parse it
+    # once
+    return _load_mat(session_dir, os.path.getmtime(session_dir))
+
+
+# session directories by session primary key, see get_session_directory
+_session_dirs = {}
+
+
+def get_session_directory(key):
+    # the directories of all sessions are fetched in one query, and fetched
+    # again when the session was inserted since
+    session_key = tuple(key[k] for k in acquisition.Session.primary_key)
+    if session_key not in _session_dirs:
+        sessions, session_dirs = acquisition.Session.fetch(
+            'KEY', 'session_directory')
+        _session_dirs.update(
+            (tuple(session[k] for k in acquisition.Session.primary_key),
+             session_dir)
+            for session, session_dir in zip(sessions, session_dirs))
+    return _session_dirs[session_key]
+
+
+@lru_cache(maxsize=1)
+def _load_mat(session_dir, mtime):
+    # only the session object is parsed, not the other top level variables
+    return sio.loadmat(session_dir, struct_as_record=False, squeeze_me=True,
+                       variable_names=['obj'])['obj']
+
+
+def _read_h5_fields(session_dir, fields):
+    # fields are paths into the 'obj' struct, e.g. 'trialPropertiesHash/value'
+    data = SimpleNamespace()
+    with h5py.File(session_dir, 'r') as f:
+        for field in fields:
+            names = field.split('/')
+            parent = data
+            for name in names[:-1]:
+                if not hasattr(parent, name):
+                    setattr(parent, name, SimpleNamespace())
+                parent = getattr(parent, name)
+            setattr(parent, names[-1], _read_h5(f, f['obj/' + field]))
+    return data
+
+
+def _read_h5(f, node):
+    # mirrors the layout of loadmat(struct_as_record=False, squeeze_me=True)
+    matlab_class = _matlab_class(node)
+
+    if isinstance(node, h5py.Group):
+        fields = {name: node[name] for name in node}
+        # struct arrays store each field as references, one per element
+        if fields and all(
+                isinstance(field, h5py.Dataset) and
+                field.dtype == h5py.ref_dtype and
+                _matlab_class(field) != 'cell'
+                for field in fields.values()):
+            refs = {name: field[()].T.ravel()
+                    for name, field in fields.items()}
+            n_elements = len(next(iter(refs.values())))
+            elements = np.empty(n_elements, dtype=object)
+            for i in range(n_elements):
+                elements[i] = SimpleNamespace(**{
+                    name: _read_h5(f, f[ref[i]]) for name, ref in refs.items()})
+            return elements[0] if n_elements == 1 else elements
+        return SimpleNamespace(**{name: _read_h5(f, field)
+                                  for name, field in fields.items()})
+
+    if node.attrs.get('MATLAB_empty', 0):
+        return '' if matlab_class == 'char' else np.array([])
+
+    value = node[()]
+    if node.dtype == h5py.ref_dtype:
+        value = value.T
+        cells = np.empty(value.size, dtype=object)
+        for i, ref in enumerate(value.ravel(order='F')):
+            cells[i] = _read_h5(f, f[ref])
+        cells = cells.reshape(value.shape, order='F').squeeze()
+        return cells[()] if cells.ndim == 0 else cells
+
+    if matlab_class == 'char':
+        return ''.join(map(chr, value.ravel()))
+
+    value = value.T.squeeze()
+    return value[()] if value.ndim == 0 else value
+
+
+def _matlab_class(node):
+    matlab_class = node.attrs.get('MATLAB_class', '')
+    if isinstance(matlab_class, bytes):
+        matlab_class = matlab_class.decode()
+    return matlab_class
+
+
+def fetch_trials(key):
+    # all trials of the session in one query, with the cue time referenced
+    # to the session start and the pole times referenced to the cue time
+    return _fetch_trials(
+        tuple((k, key[k]) for k in behavior.TrialSet.primary_key))
+
+
+def clear_trials_cache():
+    # the cache of fetch_trials is keyed on the session only, clear it before
+    # each populate run in case the trials were re-imported in the meantime
+    _fetch_trials.cache_clear()
+
+
+@lru_cache(maxsize=2)
+def _fetch_trials(session_key):
+    # units of a session are populated one after the other, they share the
+    # trials fetched for the first one; read-only as the array is shared
+    trials = (behavior.TrialSet.Trial & dict(session_key)).proj(
+        'trial_response', 'trial_lick_early', 'photo_stim_id',
+        cue_time='trial_cue_time + trial_start_time',
+        pole_in_time='trial_pole_in_time - trial_cue_time',
+        pole_out_time='trial_pole_out_time - trial_cue_time'
+    ).fetch(order_by='trial_id')
+    trials = _add_stage_windows(trials)
+    trials.flags.writeable = False
+    return trials
+
+
+# stage windows used by get_spk_counts, in secs relative to the cue time
+after_cue_time = 1.3
+before_pole_in_time = 0.5
+
+
+def _add_stage_windows(trials):
+    # start and end of the sampling, delay, response (0 to 1.3s after cue),
+    # entire (pole in to 1.3s after cue) and pre-pole in (-0.5s to pole in
+    # time) periods of each trial, computed once for the session
+    pole_in_time = trials['pole_in_time'].astype(float)
+    pole_out_time = trials['pole_out_time'].astype(float)
+    zeros = np.zeros_like(pole_in_time)
+    after_cue = np.full_like(pole_in_time, after_cue_time)
+
+    windowed = np.empty(len(trials), dtype=trials.dtype.descr + [
+        ('stage_starts', float, (5,)), ('stage_ends', float, (5,))])
+    for name in trials.dtype.names:
+        windowed[name] = trials[name]
+    windowed['stage_starts'] = np.stack(
+        [pole_in_time, pole_out_time, zeros, pole_in_time,
+         pole_in_time - before_pole_in_time], axis=1)
+    windowed['stage_ends'] = np.stack(
+        [pole_out_time, zeros, after_cue, after_cue, pole_in_time], axis=1)
+    return windowed.view(type(trials))
+
+
+def get_trials(trials, key, min_trial, max_trial, trial_type):
+    # select from the trials returned by fetch_trials
 
     if trial_type == 'All':
         if key['trial_condition'] == 'All':
-            query = {}
+            responses = None
         elif key['trial_condition'] == 'Hit':
-            query = 'trial_response in ("HitL", "HitR")'
+            responses = ['HitL', 'HitR']
     else:
         if key['trial_condition'] == 'All':
-            query = f'trial_response in ("Hit{trial_type}", "Err{trial_type}")'
+            responses = [f'Hit{trial_type}', f'Err{trial_type}']
         elif key['trial_condition'] == 'Hit':
-            query = f'trial_response = "Hit{trial_type}"'
-
-    return behavior.TrialSet.Trial & key & query & \
-        'trial_lick_early = 0' & \
-        'trial_id between {} and {}'.format(min_trial, max_trial)
-
-
-def get_spk_times(key, spk_times, spk_trials, trials):
-    return [spk_times[spk_trials == trial] -
-            (behavior.TrialSet.Trial & key &
-                'trial_id = {}'.format(trial)).proj(
-                    cue_time='trial_cue_time + trial_start_time').fetch1(
-                        'cue_time')
-            for trial in trials]
-
-
-def get_spk_counts(key, spk_times, trials):
-
-    spk_counts = []
-    for itrial, trial in enumerate(trials):
-        pole_in_time, pole_out_time = \
-            (behavior.TrialSet.Trial & key &
-                'trial_id = {}'.format(trial)).proj(
-                    pole_in_time='trial_pole_in_time - trial_cue_time',
-                    pole_out_time='trial_pole_out_time - trial_cue_time'
-            ).fetch1('pole_in_time', 'pole_out_time')
-
-        after_cue_time = 1.3
-        before_pole_in_time = 0.5
-        spk_time = spk_times[itrial]
-
-        spk_counts.append([])
-
-        spk_counts[itrial].append([])
-        # spk counts (spks/sec) in the sampling period
-        spk_counts[itrial][0] = \
-            sum((spk_time < pole_out_time) & (spk_time > pole_in_time)) / \
-            (pole_out_time - pole_in_time)
-
-        spk_counts[itrial].append([])
-        # spk counts (spks/sec) in the delay period
-        spk_counts[itrial][1] = \
-            sum((spk_time < 0) & (spk_time > pole_out_time)) / \
-            (0 - pole_out_time)
-
-        spk_counts[itrial].append([])
-        # spk counts (spks/sec) in the response period (0 to 1.3s after cue)
-        spk_counts[itrial][2] = \
-            sum((spk_time < after_cue_time) & (spk_time > 0)) / after_cue_time
-
-        # spk counts (spks/sec) in the entire period (from pole in to 1.3s
-        # after cue)
-        spk_counts[itrial].append([])
-        spk_counts[itrial][3] = \
-            sum((spk_time < after_cue_time) & (spk_time > pole_in_time)) / \
-            (after_cue_time - pole_in_time)
-
-        # spk counts (spks/sec) in the pre-pole in period (-0.5s to pole_in
-        # time)
-        spk_counts[itrial].append([])
-        spk_counts[itrial][4] = \
-            sum((spk_time < pole_in_time) &
-                (spk_time > pole_in_time - before_pole_in_time)) / \
-            before_pole_in_time
-
-    return spk_counts
+            responses = [f'Hit{trial_type}']
+
+    selected = (trials['trial_lick_early'] == 0) & \
+        (trials['trial_id'] >= min_trial) & (trials['trial_id'] <= max_trial)
+    if responses is not None:
+        selected &= np.isin(trials['trial_response'], responses)
+    if 'photo_stim_id' in key:
+        selected &= trials['photo_stim_id'] == key['photo_stim_id']
+
+    return trials[selected]
+
+
+def sort_spikes(spk_times, spk_trials):
+    # order the spikes by trial, so that get_spk_times can slice each trial
+    order = np.argsort(spk_trials, kind='stable')
+    return spk_times[order], spk_trials[order]
+
+
+def get_spk_times(spk_times, spk_trials, trials):
+    # spk_trials has to be sorted, see sort_spikes; spike times are aligned
+    # to the cue time of each trial
+    starts = np.searchsorted(spk_trials, trials['trial_id'], side='left')
+    ends = np.searchsorted(spk_trials, trials['trial_id'], side='right')
+    return [spk_times[start:end] - cue_time
+            for start, end, cue_time in zip(starts, ends, trials['cue_time'])]
+
+
+def get_spk_counts(spk_times, trials):
+    # spike rates (spks/sec) of each trial in the stage windows added by
+    # fetch_trials, one row per trial
+
+    starts = trials['stage_starts']
+    ends = trials['stage_ends']
+
+    # count the spikes of all trials at once, spikes on the window edges are
+    # left out
+    n_trials = len(spk_times)
+    trial_idx = np.repeat(np.arange(n_trials), [len(t) for t in spk_times])
+    spk_time = np.hstack(spk_times) if n_trials else np.empty(0)
+    spk_counts = np.stack(
+        [np.bincount(trial_idx,
+                     weights=(spk_time > starts[trial_idx, iwin]) &
+                     (spk_time < ends[trial_idx, iwin]),
+                     minlength=n_trials)
+         for iwin in range(starts.shape[1])], axis=1)
+
+    return spk_counts / (ends - starts)
 
 
 def get_psth(spk_times, time_bins):
 
+    # spike counts in the equal bins np.histogram uses over the range of
+    # time_bins, spikes out of the range fall into the two dropped end bins
+    n_bins = len(time_bins)
+    edges = np.linspace(min(time_bins), max(time_bins), n_bins + 1)
+    edges[-1] = np.nextafter(edges[-1], np.inf)
+    bin_idx = np.searchsorted(edges, np.hstack(spk_times), side='right')
     mean_counts = np.divide(
-        np.histogram(np.hstack(spk_times),
-                     range=[min(time_bins), max(time_bins)],
-                     bins=len(time_bins))[0],
+        np.bincount(bin_idx, minlength=n_bins + 2)[1:-1].astype(np.float32),
         len(spk_times))
 
-    # convolve with a box-car filter
+    # convolve with a box-car filter, as a running mean over the window
     window_size = 200
-    dt = np.mean(np.diff(time_bins))
-    return np.divide(signal.convolve(mean_counts, signal.boxcar(window_size), mode='same'),
-                     window_size*dt)
+    dt = float(np.mean(np.diff(time_bins)))
+    return np.divide(ndimage.uniform_filter1d(mean_counts, window_size,
+                                              mode='constant'),
+                     dt)
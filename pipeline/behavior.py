@@ -3,7 +3,7 @@ Schema of behavior information.
 '''
 import datajoint as dj
 from pipeline import reference, acquisition
-import scipy.io as sio
+from pipeline import load_session_data, get_session_directory
 import numpy as np
 import os
 import glob
@@ -58,9 +58,10 @@ class TrialSet(dj.Imported):
 
     def make(self, key):
         trial_result = key.copy()
-        session_dir = (acquisition.Session & key).fetch1('session_directory')
-        data = sio.loadmat(session_dir, struct_as_record=False,
-                           squeeze_me=True)['obj']
+        session_dir = get_session_directory(key)
+        data = load_session_data(session_dir, [
+            'trialIds', 'trialTypeStr', 'trialTypeMat', 'trialStartTimes',
+            'trialPropertiesHash/value', 'timeSeriesArrayHash/value/trial'])
 
         key.update({'number_of_trials': len(data.trialStartTimes)})
         self.insert1(key)
@@ -68,49 +69,58 @@ class TrialSet(dj.Imported):
         trial_type_str = data.trialTypeStr[:-2]
         trial_idx = data.timeSeriesArrayHash.value.trial
 
-        for idx, itrial in enumerate(data.trialIds):
-
-            trial_type_vec = np.squeeze(data.trialTypeMat[:6, idx])
-            trial_type = trial_type_str[np.array(trial_type_vec, dtype=bool)]
-
-            if len(trial_type) == 0:
-                trial_type = 'NoLickNoResponse'
-            else:
-                trial_type = trial_type[0]
-
-            pole_in_time = data.trialPropertiesHash.value[0][idx]
-            pole_out_time = data.trialPropertiesHash.value[1][idx]
-            cue_time = data.trialPropertiesHash.value[2][idx]
-            good_trial = data.trialPropertiesHash.value[3][idx]
-            photo_stim_type = data.trialPropertiesHash.value[4][idx]
-
-            if np.any(np.isnan(cue_time)):
-                continue
-
-            if np.size(cue_time) > 1:
-                cue_time = cue_time[0]
-
-            if np.any(np.isnan([pole_in_time, pole_out_time,
-                                photo_stim_type])) or good_trial == 0:
-                continue
-
-            itrial_idx = np.squeeze(np.where(trial_idx == itrial))
-            if not itrial_idx.size:
-                return
+        # trial response is the first true row of the trial type matrix
+        trial_type_mat = np.asarray(data.trialTypeMat[:6], dtype=bool)
+        trial_types = np.where(trial_type_mat.any(axis=0),
+                               trial_type_str[trial_type_mat.argmax(axis=0)],
+                               'NoLickNoResponse')
+        lick_early = np.asarray(data.trialTypeMat[6], dtype=bool)
+
+        pole_in_times, pole_out_times, cue_times, good_trials, \
+            photo_stim_types = data.trialPropertiesHash.value[:5]
+
+        # a trial may come with several cue times, only the first is kept
+        if cue_times.dtype == object:
+            cue_nan = np.array([np.any(np.isnan(cue_time))
+                                for cue_time in cue_times])
+            cue_times = np.array([np.atleast_1d(cue_time)[0]
+                                  for cue_time in cue_times])
+        else:
+            cue_nan = np.isnan(cue_times)
+
+        valid = ~cue_nan & (np.asarray(good_trials) != 0) & \
+            ~np.isnan(np.vstack([pole_in_times, pole_out_times,
+                                 photo_stim_types]).astype(float)).any(axis=0)
+
+        # first and last index of each trial on the session recording series
+        sample_trials, first_idx = np.unique(trial_idx, return_index=True)
+        last_idx = len(trial_idx) - 1 - \
+            np.unique(trial_idx[::-1], return_index=True)[1]
+        trial_ranges = dict(zip(sample_trials.tolist(),
+                                zip(first_idx, last_idx)))
+
+        trials = []
+        for idx in np.flatnonzero(valid):
+            itrial = data.trialIds[idx]
+            if itrial not in trial_ranges:
+                break
+            start_idx, end_idx = trial_ranges[itrial]
 
             trial_result.update({
                 'trial_id': itrial,
                 'trial_start_time': data.trialStartTimes[idx],
-                'trial_pole_in_time': pole_in_time,
-                'trial_pole_out_time': pole_out_time,
-                'trial_cue_time': cue_time,
-                'trial_response': trial_type,
-                'trial_lick_early': bool(data.trialTypeMat[6][idx]),
-                'photo_stim_id': str(int(photo_stim_type)),
-                'trial_start_idx': itrial_idx[0],
-                'trial_end_idx': itrial_idx[-1]
+                'trial_pole_in_time': pole_in_times[idx],
+                'trial_pole_out_time': pole_out_times[idx],
+                'trial_cue_time': cue_times[idx],
+                'trial_response': trial_types[idx],
+                'trial_lick_early': bool(lick_early[idx]),
+                'photo_stim_id': str(int(photo_stim_types[idx])),
+                'trial_start_idx': start_idx,
+                'trial_end_idx': end_idx
             })
-            self.Trial().insert1(trial_result)
+            trials.append(trial_result.copy())
+
+        self.Trial().insert(trials)
 
     class Trial(dj.Part):
         definition = """
@@ -146,15 +156,14 @@ class TrialSetType(dj.Computed):
     """
 
     def make(self, key):
-        activation = TrialSet.Trial & key & \
-            (PhotoStimType & 'photo_stim_act_type="activation"')
-        inhibition = TrialSet.Trial & key & \
-            (PhotoStimType & 'photo_stim_act_type="inhibition"')
+        # stimulation types used in the session, in one query
+        act_types = (PhotoStimType & (TrialSet.Trial & key)).fetch(
+            'photo_stim_act_type')
 
-        if len(activation):
+        if 'activation' in act_types:
             key['trial_set_type'] = 'photo activation'
 
-        if len(inhibition):
+        if 'inhibition' in act_types:
             key['trial_set_type'] = 'photo inhibition'
 
         self.insert1(key)
@@ -177,13 +186,22 @@ class TrialNumberSummary(dj.Computed):
         TrialSet.Trial & 'photo_stim_id in ("1","2","3","4")')
 
     def make(self, key):
+        # fetch the trials once and count each group in numpy
+        photo_stim_id, trial_response = (TrialSet.Trial & key).fetch(
+            'photo_stim_id', 'trial_response')
+        sample = np.isin(photo_stim_id, ['1', '3'])
+        delay = np.isin(photo_stim_id, ['2', '4'])
+        no_stim = photo_stim_id == '0'
+        left = np.isin(trial_response, ['HitL', 'ErrL'])
+        right = np.isin(trial_response, ['HitR', 'ErrR'])
+
         key.update(
-            n_sample_l_trials=len(TrialSet.Trial & key & 'photo_stim_id in ("1","3")' & 'trial_response in ("HitL", "ErrL")'),
-            n_sample_r_trials=len(TrialSet.Trial & key & 'photo_stim_id in ("1","3")' & 'trial_response in ("HitR", "ErrR")'),
-            n_delay_l_trials=len(TrialSet.Trial & key & 'photo_stim_id in ("2","4")' & 'trial_response in ("HitL", "ErrL")'),
-            n_delay_r_trials=len(TrialSet.Trial & key & 'photo_stim_id in ("2","4")' & 'trial_response in ("HitR", "ErrR")'),
-            n_no_stim_l_trials=len(TrialSet.Trial & key & 'photo_stim_id="0"' & 'trial_response in ("HitL", "ErrL")'),
-            n_no_stim_r_trials=len(TrialSet.Trial & key & 'photo_stim_id="0"' & 'trial_response in ("HitR", "ErrR")'),
+            n_sample_l_trials=int(np.sum(sample & left)),
+            n_sample_r_trials=int(np.sum(sample & right)),
+            n_delay_l_trials=int(np.sum(delay & left)),
+            n_delay_r_trials=int(np.sum(delay & right)),
+            n_no_stim_l_trials=int(np.sum(no_stim & left)),
+            n_no_stim_r_trials=int(np.sum(no_stim & right)),
         )
 
         key['n_test_trials'] = np.mean([key['n_sample_l_trials'],
@@ -4,17 +4,25 @@ Schema of session information.
 import datajoint as dj
 from . import reference, acquisition, behavior
 from . import get_trials, get_spk_times, get_spk_counts, get_psth
-import scipy.io as sio
+from . import fetch_trials, clear_trials_cache, sort_spikes
+from . import load_session_data
 import scipy.stats as ss
 import numpy as np
-from numpy import random
+from functools import lru_cache
 import os
 import glob
 import re
+import zlib
 from datetime import datetime
 
 schema = dj.schema('gao2018_ephys')
 
+# time window and bins of the psths, in secs relative to the cue time; the
+# spikes are binned with the float64 bins, the stored copies are float32
+time_window = [-3.5, 2]
+bins = np.arange(time_window[0], time_window[1]+0.001, 0.001)
+bins_float32 = bins.astype(np.float32)
+
 
 @schema
 class ProbeInsertion(dj.Manual):
@@ -57,6 +65,8 @@ class UnitSpikeTimes(dj.Imported):
     -> reference.Probe.Channel.proj(channel = 'channel_id')
     spike_times: longblob  # (s) time of each spike, with respect to the start of session
     spike_trials: longblob # which trial each spike belongs to.
+    min_trial: int         # first trial with spikes of this unit
+    max_trial: int         # last trial with spikes of this unit
     unit_cell_type='unknown': varchar(32)  # e.g. cell-type of this unit (e.g. wide width, narrow width spiking)
     spike_waveform: longblob  # waveform(s) of each spike at each spike time (spike_time x waveform_timestamps)
     unit_x=null: float  # (mm)
@@ -68,36 +78,76 @@ class UnitSpikeTimes(dj.Imported):
     def make(self, key):
         print(key)
 
-        session_dir = (acquisition.Session & key).fetch1('session_directory')
-        data = sio.loadmat(session_dir, struct_as_record=False,
-                           squeeze_me=True)['obj']
+        session_dir, probe_type = (acquisition.Session * ProbeInsertion &
+                                   key).fetch1('session_directory',
+                                               'probe_type')
+        data = load_session_data(session_dir, ['eventSeriesHash/value'])
 
-        for iunit, unit in enumerate(data.eventSeriesHash.value):
-            value = data.eventSeriesHash.value[iunit]
+        channels = set()
+        units = []
+        for iunit, value in enumerate(data.eventSeriesHash.value):
 
-            # insert the channel entry into the table reference.Probe.Channel
-            probe_type = (ProbeInsertion & key).fetch1('probe_type')
-            channel = np.unique(value.channel)[0]
-            probe_channel = {
-                'probe_type': probe_type,
-                'channel_id': channel
-            }
-            reference.Probe.Channel.insert1(probe_channel,
-                                            skip_duplicates=True)
+            # collect the channel entries for the table reference.Probe.Channel
+            channel = int(np.min(value.channel))
+            channels.add(channel)
+
+            spike_trials = np.asarray(value.eventTrials, dtype=np.int32)
+
+            # waveforms in raw ADC units are stored as int16, only if that is
+            # lossless
+            waveforms = np.asarray(value.waveforms)
+            with np.errstate(invalid='ignore'):
+                waveforms_int16 = waveforms.astype(np.int16)
+            if np.array_equal(waveforms, waveforms_int16):
+                waveforms = waveforms_int16
 
             key.update({
                 'unit_id': iunit,
                 'spike_times': value.eventTimes,
-                'spike_trials': value.eventTrials,
+                'spike_trials': spike_trials,
+                'min_trial': int(np.min(spike_trials)),
+                'max_trial': int(np.max(spike_trials)),
                 'probe_type': probe_type,
                 'channel': channel,
-                'spike_waveform': value.waveforms
+                'spike_waveform': waveforms
             })
 
-            if np.size(value.cellType):
-                key['unit_cell_type'] = value.cellType
+            # empty cell types come out of loadmat as empty arrays
+            cell_type = value.cellType
+            key['unit_cell_type'] = \
+                cell_type if isinstance(cell_type, str) and cell_type \
+                else 'unknown'
+
+            units.append(key.copy())
+
+        # the channels are inserted with the probe during ingestion, this only
+        # finds them already there, unless a unit is on a channel beyond them
+        reference.Probe.Channel.insert(
+            [{'probe_type': probe_type, 'channel_id': channel}
+             for channel in channels], skip_duplicates=True)
+        self.insert(units)
+
+
+def fetch_unit_spikes(key):
+    # spike times and trials of a unit, sorted by trial
+    return _fetch_unit_spikes(
+        tuple((k, key[k]) for k in UnitSpikeTimes.primary_key))
 
-            self.insert1(key)
+
+@lru_cache(maxsize=4)
+def _fetch_unit_spikes(unit):
+    # within a populate call restricted to one session, the make calls of a
+    # unit (one per trial condition or photo stim type) follow each other in
+    # key order and share one fetch of the blobs
+    spk_times, spk_trials = (UnitSpikeTimes & dict(unit)).fetch1(
+        'spike_times', 'spike_trials')
+    return sort_spikes(spk_times, spk_trials)
+
+
+def _clear_fetch_caches():
+    # the fetch caches only hold within one populate call
+    clear_trials_cache()
+    _fetch_unit_spikes.cache_clear()
 
 
 @schema
@@ -136,56 +186,57 @@ class UnitSelectivity(dj.Computed):
          (behavior.TrialSetType & 'trial_set_type="photo inhibition"')) * \
         (behavior.TrialCondition & 'trial_condition="Hit"')
 
+    def populate(self, *args, **kwargs):
+        _clear_fetch_caches()
+        return super().populate(*args, **kwargs)
+
     def make(self, key):
 
         selectivity = key.copy()
+        # seeded by the key, so that reruns pick the same screening trials
+        rng = np.random.default_rng(
+            zlib.crc32(str(sorted(key.items())).encode()))
         key_no_stim = key.copy()
         key_no_stim['photo_stim_id'] = '0'
 
-        spk_times, spk_trials = (UnitSpikeTimes & key).fetch1(
-                'spike_times', 'spike_trials')
-
-        min_trial = np.min(spk_trials)
-        max_trial = np.max(spk_trials)
+        # select the trials from the stored trial range of the unit, the
+        # spikes are only fetched if there are enough of them
+        trials = fetch_trials(key)
+        min_trial, max_trial = (UnitSpikeTimes & key).fetch1(
+            'min_trial', 'max_trial')
 
-        r_trials = get_trials(key_no_stim, min_trial, max_trial, 'R')
-        l_trials = get_trials(key_no_stim, min_trial, max_trial, 'L')
-        all_trials = get_trials(key_no_stim, min_trial, max_trial, 'All')
+        r_trials = get_trials(trials, key_no_stim, min_trial, max_trial, 'R')
+        l_trials = get_trials(trials, key_no_stim, min_trial, max_trial, 'L')
+        all_trials = get_trials(trials, key_no_stim, min_trial, max_trial,
+                                'All')
 
         if not (len(l_trials) > 8 and len(r_trials) > 8):
             return
 
-        r_trial_ids = r_trials.fetch('trial_id')
-        l_trial_ids = l_trials.fetch('trial_id')
-        all_trial_ids = all_trials.fetch('trial_id')
+        spk_times, spk_trials = fetch_unit_spikes(key)
+
+        r_trial_ids = r_trials['trial_id']
+        l_trial_ids = l_trials['trial_id']
 
         # spike times
-        spk_times_r = get_spk_times(key, spk_times, spk_trials,
-                                    r_trial_ids)
-        spk_times_l = get_spk_times(key, spk_times, spk_trials,
-                                    l_trial_ids)
-        spk_times_all = get_spk_times(key, spk_times, spk_trials,
-                                      all_trial_ids)
+        spk_times_r = get_spk_times(spk_times, spk_trials, r_trials)
+        spk_times_l = get_spk_times(spk_times, spk_trials, l_trials)
+        spk_times_all = get_spk_times(spk_times, spk_trials, all_trials)
 
         # spike counts in different stages
-        spk_counts_r = np.array(get_spk_counts(key, spk_times_r, r_trial_ids))
-        spk_counts_l = np.array(get_spk_counts(key, spk_times_l, l_trial_ids))
-        spk_counts_all = np.array(get_spk_counts(key, spk_times_all, all_trial_ids))
-
-        mean_fr_r = np.mean(spk_counts_r, axis=0)
-        mean_fr_l = np.mean(spk_counts_l, axis=0)
-        mean_fr_all = np.mean(spk_counts_all, axis=0)
-
-        # check selectivity
-        result_sample = ss.ttest_ind(spk_counts_r[:, 0],
-                                     spk_counts_l[:, 0])
-        result_delay = ss.ttest_ind(spk_counts_r[:, 1],
-                                    spk_counts_l[:, 1])
-        result_response = ss.ttest_ind(spk_counts_r[:, 2],
-                                       spk_counts_l[:, 2])
-        sample_selectivity = int(result_sample.pvalue < 0.05)
-        delay_selectivity = int(result_delay.pvalue < 0.05)
-        response_selectivity = int(result_response.pvalue < 0.05)
+        spk_counts_r = np.array(get_spk_counts(spk_times_r, r_trials))
+        spk_counts_l = np.array(get_spk_counts(spk_times_l, l_trials))
+        spk_counts_all = np.array(get_spk_counts(spk_times_all, all_trials))
+
+        mean_fr_r = np.mean(spk_counts_r, axis=0).astype(np.float32)
+        mean_fr_l = np.mean(spk_counts_l, axis=0).astype(np.float32)
+        mean_fr_all = np.mean(spk_counts_all, axis=0).astype(np.float32)
+
+        # check selectivity, in the sample, delay and response periods at once
+        result = ss.ttest_ind(spk_counts_r[:, :3], spk_counts_l[:, :3],
+                              axis=0)
+        sample_selectivity, delay_selectivity, response_selectivity = \
+            (result.pvalue < 0.05).astype(int).tolist()
 
         # screen size depends on the experimental type
         trial_set_type = (behavior.TrialSetType & key).fetch1('trial_set_type')
@@ -194,37 +245,26 @@ class UnitSelectivity(dj.Computed):
         else:
             screen_size = 5
 
-        random.shuffle(r_trial_ids)
-        random.shuffle(l_trial_ids)
-
-        spk_times_r_screen = get_spk_times(key, spk_times, spk_trials,
-                                           r_trial_ids[:screen_size])
-        mean_fr_r_screen = np.mean(get_spk_counts(key,
-                                                  spk_times_r_screen,
-                                                  r_trial_ids[:screen_size]),
-                                   axis=0)
-
-        spk_times_l_screen = get_spk_times(key, spk_times, spk_trials,
-                                           l_trial_ids[:screen_size])
-        mean_fr_l_screen = np.mean(get_spk_counts(key,
-                                                  spk_times_l_screen,
-                                                  l_trial_ids[:screen_size]),
-                                   axis=0)
-
-        spk_times_r_test = get_spk_times(key, spk_times, spk_trials,
-                                         r_trial_ids[screen_size:])
-        spk_counts_r_test = get_spk_counts(key, spk_times_r_test,
-                                           r_trial_ids[screen_size:])
-
-        spk_times_l_test = get_spk_times(key, spk_times, spk_trials,
-                                         l_trial_ids[screen_size:])
-        spk_counts_l_test = get_spk_counts(key, spk_times_l_test,
-                                           l_trial_ids[screen_size:])
+        # screening trials are drawn at random, the rest are test trials
+        r_screen_idx = rng.permutation(len(r_trials))[:screen_size]
+        l_screen_idx = rng.permutation(len(l_trials))[:screen_size]
+        r_trials_screen = r_trials[r_screen_idx]
+        l_trials_screen = l_trials[l_screen_idx]
+        r_screen = np.zeros(len(r_trials), dtype=bool)
+        r_screen[r_screen_idx] = True
+        l_screen = np.zeros(len(l_trials), dtype=bool)
+        l_screen[l_screen_idx] = True
+
+        # take the screening and test trials out of the spikes and counts
+        # of all the trials computed above
+        mean_fr_r_screen = np.mean(spk_counts_r[r_screen], axis=0)
+        mean_fr_l_screen = np.mean(spk_counts_l[l_screen], axis=0)
+        spk_times_r_test = [spk_time for spk_time, screen
+                            in zip(spk_times_r, r_screen) if not screen]
+        spk_times_l_test = [spk_time for spk_time, screen
+                            in zip(spk_times_l, l_screen) if not screen]
 
         # compute convoluted psth
-        time_window = [-3.5, 2]
-        bins = np.arange(time_window[0], time_window[1]+0.001, 0.001)
-
         psth_r_test = get_psth(spk_times_r_test, bins)
         psth_l_test = get_psth(spk_times_l_test, bins)
         if mean_fr_r_screen[3] > mean_fr_l_screen[3]:
@@ -250,9 +290,9 @@ class UnitSelectivity(dj.Computed):
             'selectivity': int(np.any([sample_selectivity, delay_selectivity,
                                        response_selectivity])),
             'time_window': time_window,
-            'bins': bins,
-            'trial_ids_screened_r': r_trial_ids[:screen_size],
-            'trial_ids_screened_l': l_trial_ids[:screen_size],
+            'bins': bins_float32,
+            'trial_ids_screened_r': r_trials_screen['trial_id'],
+            'trial_ids_screened_l': l_trials_screen['trial_id'],
             'psth_r_test': psth_r_test,
             'psth_l_test': psth_l_test,
             'psth_prefer_test': psth_prefer_test,
@@ -286,47 +326,45 @@ class AlignedPsthStimOn(dj.Computed):
     psth_diff_on:         longblob    # psth difference betweens preferred trials and non-preferred trials
     """
 
-    def make(self, key):
+    # only selective units, under photo stimulation; joined on the primary
+    # keys only, PhotoStimType has the stimulated brain_location as a
+    # secondary attribute
+    key_source = (UnitSelectivity & 'selectivity=1').proj() * \
+        (behavior.PhotoStimType & 'photo_stim_id not in ("NaN", "0")').proj()
 
-        if key['photo_stim_id'] in ['NaN', '0']:
-            return
+    def populate(self, *args, **kwargs):
+        _clear_fetch_caches()
+        return super().populate(*args, **kwargs)
 
-        time_window, bins, preference, selectivity = \
-            (UnitSelectivity & key).fetch1(
-                'time_window', 'bins', 'preference', 'selectivity')
+    def make(self, key):
 
-        if not selectivity:
-            return
+        preference = (UnitSelectivity & key).fetch1('preference')
 
         aligned_psth = key.copy()
 
-        spk_times, spk_trials = (UnitSpikeTimes & key).fetch1(
-            'spike_times', 'spike_trials')
-        min_trial = min(spk_trials)
-        max_trial = max(spk_trials)
-        r_trials = get_trials(key, min_trial, max_trial, 'R')
-        l_trials = get_trials(key, min_trial, max_trial, 'L')
-        all_trials = get_trials(key, min_trial, max_trial, 'All')
+        # select the trials from the stored trial range of the unit, the
+        # spikes are only fetched if there are enough of them
+        trials = fetch_trials(key)
+        min_trial, max_trial = (UnitSpikeTimes & key).fetch1(
+            'min_trial', 'max_trial')
+        r_trials = get_trials(trials, key, min_trial, max_trial, 'R')
+        l_trials = get_trials(trials, key, min_trial, max_trial, 'L')
+        all_trials = get_trials(trials, key, min_trial, max_trial, 'All')
 
         if not (len(l_trials) > 2 and len(r_trials) > 2):
             return
 
-        r_trial_ids = r_trials.fetch('trial_id')
-        l_trial_ids = l_trials.fetch('trial_id')
-        all_trial_ids = all_trials.fetch('trial_id')
+        spk_times, spk_trials = fetch_unit_spikes(key)
 
         # spike times
-        spk_times_r = get_spk_times(key, spk_times, spk_trials,
-                                    r_trial_ids)
-        spk_times_l = get_spk_times(key, spk_times, spk_trials,
-                                    l_trial_ids)
-        spk_times_all = get_spk_times(key, spk_times, spk_trials,
-                                      all_trial_ids)
+        spk_times_r = get_spk_times(spk_times, spk_trials, r_trials)
+        spk_times_l = get_spk_times(spk_times, spk_trials, l_trials)
+        spk_times_all = get_spk_times(spk_times, spk_trials, all_trials)
 
         # spike counts in different stages
-        spk_counts_r = np.array(get_spk_counts(key, spk_times_r, r_trial_ids))
-        spk_counts_l = np.array(get_spk_counts(key, spk_times_l, l_trial_ids))
-        spk_counts_all = np.array(get_spk_counts(key, spk_times_all, all_trial_ids))
+        spk_counts_r = np.array(get_spk_counts(spk_times_r, r_trials))
+        spk_counts_l = np.array(get_spk_counts(spk_times_l, l_trials))
+        spk_counts_all = np.array(get_spk_counts(spk_times_all, all_trials))
 
         # compute convoluted psth
         psth_r = get_psth(spk_times_r, bins)
@@ -342,9 +380,10 @@ class AlignedPsthStimOn(dj.Computed):
         aligned_psth.update({
             'r_trial_number_on': len(r_trials),
             'l_trial_number_on': len(l_trials),
-            'mean_fr_r_on': np.mean(spk_counts_r, axis=0),
-            'mean_fr_l_on': np.mean(spk_counts_l, axis=0),
-            'mean_fr_all_on': np.mean(spk_counts_all, axis=0),
+            'mean_fr_r_on': np.mean(spk_counts_r, axis=0).astype(np.float32),
+            'mean_fr_l_on': np.mean(spk_counts_l, axis=0).astype(np.float32),
+            'mean_fr_all_on': np.mean(spk_counts_all,
+                                      axis=0).astype(np.float32),
             'psth_r_on': psth_r,
             'psth_l_on': psth_l,
             'psth_prefer_on': psth_prefer,
@@ -368,6 +407,10 @@ class PsthForCodingDirection(dj.Computed):
         'n_no_stim_l_trials > 5' & 'n_no_stim_r_trials > 5'
     )
 
+    def populate(self, *args, **kwargs):
+        _clear_fetch_caches()
+        return super().populate(*args, **kwargs)
+
     def make(self, key):
         self.insert1(key)
         testing_trial_num = (behavior.TrialNumberSummary & key).fetch1('n_test_trials')
@@ -375,62 +418,64 @@ class PsthForCodingDirection(dj.Computed):
         keys_stim_off = []
         keys_stim_on = []
 
-        for ikey in (UnitSpikeTimes & key).fetch('KEY'):
-            print("Populating {}th unit".format(ikey['unit_id']))
-            spk_times, spk_trials = (UnitSpikeTimes & ikey).fetch1(
-                'spike_times', 'spike_trials')
+        trials = fetch_trials(key)
+        photo_stim_ids = np.unique(
+            trials['photo_stim_id'][trials['photo_stim_id'] != '0'])
 
-            min_trial = np.min(spk_trials)
-            max_trial = np.max(spk_trials)
+        for ikey, min_trial, max_trial in zip(*(UnitSpikeTimes & key).fetch(
+                'KEY', 'min_trial', 'max_trial')):
+            print("Populating {}th unit".format(ikey['unit_id']))
 
             cond_hit = dict(**ikey, trial_condition='Hit',
                             photo_stim_id='0')
             cond_all = dict(**ikey, trial_condition='All',
                             photo_stim_id='0')
 
-            r_trials_hit = get_trials(cond_hit, min_trial, max_trial, 'R')
-            r_trials_all = get_trials(cond_all, min_trial, max_trial, 'R')
-            l_trials_hit = get_trials(cond_hit, min_trial, max_trial, 'L')
-            l_trials_all = get_trials(cond_all, min_trial, max_trial, 'L')
-
-            r_trial_ids_hit = r_trials_hit.fetch('trial_id')
-            l_trial_ids_hit = l_trials_hit.fetch('trial_id')
-            r_trial_ids_all = r_trials_all.fetch('trial_id')
-            l_trial_ids_all = l_trials_all.fetch('trial_id')
+            r_trials_hit = get_trials(trials, cond_hit, min_trial, max_trial, 'R')
+            r_trials_all = get_trials(trials, cond_all, min_trial, max_trial, 'R')
+            l_trials_hit = get_trials(trials, cond_hit, min_trial, max_trial, 'L')
+            l_trials_all = get_trials(trials, cond_all, min_trial, max_trial, 'L')
 
             # training trials only comes from the hit trials
-            r_training_trial_ids = list(r_trial_ids_hit[testing_trial_num:])
-            l_training_trial_ids = list(l_trial_ids_hit[testing_trial_num:])
-            all_training_trial_ids = r_training_trial_ids + l_training_trial_ids
+            r_training_trials = r_trials_hit[testing_trial_num:]
+            l_training_trials = l_trials_hit[testing_trial_num:]
+            all_training_trials = np.concatenate([r_training_trials,
+                                                  l_training_trials])
+            r_training_trial_ids = list(r_training_trials['trial_id'])
+            l_training_trial_ids = list(l_training_trials['trial_id'])
 
             if len(r_training_trial_ids) < 10 or len(l_training_trial_ids) < 10:
                 continue
 
+            spk_times, spk_trials = (UnitSpikeTimes & ikey).fetch1(
+                'spike_times', 'spike_trials')
+            spk_times, spk_trials = sort_spikes(spk_times, spk_trials)
+
             # test trials are the rest of all trials, including hit and err
-            r_test_trial_ids = [id for id in r_trial_ids_all if id not in r_training_trial_ids]
-            l_test_trial_ids = [id for id in l_trial_ids_all if id not in l_training_trial_ids]
+            r_test_trials = r_trials_all[
+                ~np.isin(r_trials_all['trial_id'], r_training_trial_ids)]
+            l_test_trials = l_trials_all[
+                ~np.isin(l_trials_all['trial_id'], l_training_trial_ids)]
 
             # spike times
             spk_times_r_test = get_spk_times(
-                ikey, spk_times, spk_trials, r_test_trial_ids)
+                spk_times, spk_trials, r_test_trials)
             spk_times_r_training = get_spk_times(
-                ikey, spk_times, spk_trials, r_training_trial_ids)
+                spk_times, spk_trials, r_training_trials)
             spk_times_l_test = get_spk_times(
-                ikey, spk_times, spk_trials, l_test_trial_ids)
+                spk_times, spk_trials, l_test_trials)
             spk_times_l_training = get_spk_times(
-                ikey, spk_times, spk_trials, l_training_trial_ids)
+                spk_times, spk_trials, l_training_trials)
 
             spk_times_all_training = get_spk_times(
-                ikey, spk_times, spk_trials, all_training_trial_ids)
+                spk_times, spk_trials, all_training_trials)
 
             # spike counts for different periods
-            spk_counts_r_training = np.array(get_spk_counts(ikey, spk_times_r_training, r_training_trial_ids))
-            spk_counts_l_training = np.array(get_spk_counts(ikey, spk_times_l_training, l_training_trial_ids))
-            spk_counts_all_training = np.array(get_spk_counts(ikey, spk_times_all_training, all_training_trial_ids))
+            spk_counts_r_training = np.array(get_spk_counts(spk_times_r_training, r_training_trials))
+            spk_counts_l_training = np.array(get_spk_counts(spk_times_l_training, l_training_trials))
+            spk_counts_all_training = np.array(get_spk_counts(spk_times_all_training, all_training_trials))
 
             # compute psth for no photo stim test trials
-            time_window = [-3.5, 2]
-            bins = np.arange(time_window[0], time_window[1]+0.001, 0.001)
             psth_r_test = get_psth(spk_times_r_test, bins)
             psth_l_test = get_psth(spk_times_l_test, bins)
             psth_r_training = get_psth(spk_times_r_training, bins)
@@ -442,9 +487,12 @@ class PsthForCodingDirection(dj.Computed):
             key_training.update(
                 r_training_trial_ids=r_training_trial_ids,
                 l_training_trial_ids=l_training_trial_ids,
-                mean_fr_l_training=np.mean(spk_counts_l_training, axis=0),
-                mean_fr_r_training=np.mean(spk_counts_r_training, axis=0),
-                mean_fr_all_training=np.mean(spk_counts_all_training, axis=0),
+                mean_fr_l_training=np.mean(
+                    spk_counts_l_training, axis=0).astype(np.float32),
+                mean_fr_r_training=np.mean(
+                    spk_counts_r_training, axis=0).astype(np.float32),
+                mean_fr_all_training=np.mean(
+                    spk_counts_all_training, axis=0).astype(np.float32),
                 spk_times_l_training=spk_times_l_training,
                 spk_times_r_training=spk_times_r_training,
                 psth_l_training=psth_l_training,
@@ -461,24 +509,21 @@ class PsthForCodingDirection(dj.Computed):
                 psth_r_test=psth_r_test,
                 spk_times_l_test=spk_times_l_test,
                 spk_times_r_test=spk_times_r_test,
-                time_bins=bins
+                time_bins=bins_float32
             )
             keys_stim_off.append(key_stim_off)
 
             # ingest PSTH for photo stim on trials
-            photo_stims = dj.U('photo_stim_id') & (behavior.TrialSet.Trial & key & 'photo_stim_id != "0"')
-            for photo_stim in photo_stims.fetch('KEY'):
+            for photo_stim_id in photo_stim_ids:
                 cond_all = dict(**ikey, trial_condition='All',
-                                photo_stim_id=photo_stim['photo_stim_id'])
-                r_trials_all = get_trials(cond_all, min_trial, max_trial, 'R')
-                l_trials_all = get_trials(cond_all, min_trial, max_trial, 'L')
+                                photo_stim_id=photo_stim_id)
+                r_trials_all = get_trials(trials, cond_all, min_trial, max_trial, 'R')
+                l_trials_all = get_trials(trials, cond_all, min_trial, max_trial, 'L')
 
-                r_trial_ids = r_trials_all.fetch('trial_id')
-                l_trial_ids = l_trials_all.fetch('trial_id')
                 spk_times_r = get_spk_times(
-                    ikey, spk_times, spk_trials, r_trial_ids)
+                    spk_times, spk_trials, r_trials_all)
                 spk_times_l = get_spk_times(
-                    ikey, spk_times, spk_trials, l_trial_ids)
+                    spk_times, spk_trials, l_trials_all)
 
                 if not (len(spk_times_r) and len(spk_times_l)):
                     continue
@@ -487,12 +532,12 @@ class PsthForCodingDirection(dj.Computed):
 
                 key_stim_on = ikey.copy()
                 key_stim_on.update(
-                    photo_stim_id=photo_stim['photo_stim_id'],
+                    photo_stim_id=photo_stim_id,
                     psth_l_test=psth_l,
                     psth_r_test=psth_r,
                     spk_times_l_test=spk_times_l,
                     spk_times_r_test=spk_times_r,
-                    time_bins=bins
+                    time_bins=bins_float32
                 )
                 keys_stim_on.append(key_stim_on)
 
@@ -7,229 +7,297 @@ import scipy.io as sio
 import numpy as np
 import os
 import glob
+import multiprocessing
 import re
 from datetime import datetime
 from pipeline import reference, subject, action, acquisition, behavior, ephys
 
-# insert the meta data
-print('Ingesting meta data...')
-files1 = glob.glob('/data/datafiles/meta_data*')
-files2 = glob.glob('/data/datafiles 2/meta_data*')
-files = np.hstack([files1, files2])
+# number of channels, as written in the probe type name
+probe_channels_re = re.compile(r'\s\d{2}')
 
+# words picked out of the location descriptions
+hemispheres = frozenset(['left', 'right'])
+brain_locations = frozenset(['Fastigial', 'Dentate', 'DCN', 'ALM'])
+coordinate_refs = frozenset(['lambda', 'bregma'])
 
-for file in files:
+kargs = dict(
+    display_progress=True,
+    suppress_errors=True
+)
+
+
+def ingest_meta_data(file):
     data = \
-        sio.loadmat(file, struct_as_record=False, squeeze_me=True)['meta_data']
-
-    # ====== reference tables ======
-    reference.AnimalSource.insert1([data.animalSource], skip_duplicates=True)
-    reference.WhiskerConfig.insert1([data.whiskerConfig], skip_duplicates=True)
-    reference.Experimenter.insert1([data.experimenters], skip_duplicates=True)
-    reference.ReferenceAtlas.insert1([data.referenceAtlas],
-                                     skip_duplicates=True)
-
-    # ====== subject tables ======
-    subject.Species.insert1([data.species], skip_duplicates=True)
-
-    animal = {
-        'subject': data.animalID,
-        'species': data.species,
-        'sex': data.sex,
-        'date_of_birth': data.dateOfBirth,
-        'animal_source': data.animalSource
-    }
-    subject.Subject.insert1(animal, skip_duplicates=True)
-
-    zygosity = {'subject': data.animalID}
-    alleles = data.animalGeneModification
-    if alleles.size > 0:
-        strains = data.animalStrain
-        if type(strains) == str:
-            strains = [strains]
-        for i_allele, allele in enumerate(alleles):
-            strain = str(strains[i_allele])
-            subject.Allele.insert1([allele, strain], skip_duplicates=True)
-            zygosity['allele'] = allele
-            copy = data.animalGeneCopy[i_allele]
-            if copy == 0:
-                zygosity['zygosity'] = 'Negative'
-            elif copy == 1:
-                zygosity['zygosity'] = 'Heterozygous'
-            elif copy == 2:
-                zygosity['zygosity'] = 'Homozygous'
-            else:
-                print('Invalid zygosity')
-                continue
-            subject.Zygosity.insert1(zygosity, skip_duplicates=True)
-
-    # ====== action tables ======
-    if data.weightBefore.size > 0 and data.weightAfter > 0:
-        weighing = {
+        sio.loadmat(file, struct_as_record=False, squeeze_me=True,
+                    variable_names=['meta_data'])['meta_data']
+
+    # commit the entries of a session file at once rather than per insert,
+    # or none of them if any insert fails
+    with dj.conn().transaction:
+        # ====== reference tables ======
+        reference.AnimalSource.insert1([data.animalSource],
+                                       skip_duplicates=True)
+        reference.WhiskerConfig.insert1([data.whiskerConfig],
+                                        skip_duplicates=True)
+        reference.Experimenter.insert1([data.experimenters],
+                                       skip_duplicates=True)
+        reference.ReferenceAtlas.insert1([data.referenceAtlas],
+                                         skip_duplicates=True)
+
+        # ====== subject tables ======
+        subject.Species.insert1([data.species], skip_duplicates=True)
+
+        animal = {
             'subject': data.animalID,
-            'weight_before': data.weightBefore,
-            'weight_after': data.weightAfter
+            'species': data.species,
+            'sex': data.sex,
+            'date_of_birth': data.dateOfBirth,
+            'animal_source': data.animalSource
         }
-        action.Weighing.insert1(weighing, skip_duplicates=True)
-
-    whisker = {
-        'subject': data.animalID,
-        'whisker_config': data.whiskerConfig
-    }
-    action.SubjectWhiskerConfig.insert1(whisker, skip_duplicates=True)
-
-    # virus related tables
-    if hasattr(data, 'virus'):
-        reference.VirusSource.insert1([data.virus.virusSource],
-                                      skip_duplicates=True)
-        virus = {
-            'virus': data.virus.virusID,
-            'virus_source': data.virus.virusSource
-        }
-        reference.Virus.insert1(virus, skip_duplicates=True)
+        subject.Subject.insert1(animal, skip_duplicates=True)
 
-        location = data.virus.infectionLocation
-        words = re.sub("[^\w]", " ", location).split()
-        hemisphere = np.array(words)[np.array([(word in ['left', 'right'])
-                                              for word in words])]
-        loc = np.array(words)[np.array([
-            (word in ['Fastigial', 'Dentate', 'DCN', 'ALM']) for word in words
-            ])]
-        ref = np.array(words)[np.array([
-            (word in ['lambda', 'bregma']) for word in words
-            ])]
-        virus_injection = {
+        zygosity = {'subject': data.animalID}
+        alleles = data.animalGeneModification
+        if alleles.size > 0:
+            strains = data.animalStrain
+            if type(strains) == str:
+                strains = [strains]
+            allele_entries = []
+            zygosities = []
+            for i_allele, allele in enumerate(alleles):
+                strain = str(strains[i_allele])
+                allele_entries.append([allele, strain])
+                zygosity['allele'] = allele
+                copy = data.animalGeneCopy[i_allele]
+                if copy == 0:
+                    zygosity['zygosity'] = 'Negative'
+                elif copy == 1:
+                    zygosity['zygosity'] = 'Heterozygous'
+                elif copy == 2:
+                    zygosity['zygosity'] = 'Homozygous'
+                else:
+                    print('Invalid zygosity')
+                    continue
+                zygosities.append(zygosity.copy())
+            subject.Allele.insert(allele_entries, skip_duplicates=True)
+            subject.Zygosity.insert(zygosities, skip_duplicates=True)
+
+        # ====== action tables ======
+        if data.weightBefore.size > 0 and data.weightAfter > 0:
+            weighing = {
+                'subject': data.animalID,
+                'weight_before': data.weightBefore,
+                'weight_after': data.weightAfter
+            }
+            action.Weighing.insert1(weighing, skip_duplicates=True)
+
+        whisker = {
             'subject': data.animalID,
-            'virus': data.virus.virusID,
-            'brain_location': str(np.squeeze(loc)),
-            'hemisphere': str(np.squeeze(hemisphere)),
-            'injection_volume': data.virus.injectionVolume,
-            'injection_date': datetime.strptime(data.virus.injectionDate,
-                                                '%Y%m%d').date(),
-            'injection_coordinate_ap': data.virus.infectionCoordinates[0],
-            'injection_coordinate_ml': data.virus.infectionCoordinates[1],
-            'injection_coordinate_dv': data.virus.infectionCoordinates[2],
-            'coordinate_ref': str(np.squeeze(ref))
-        }
-        action.VirusInjection.insert1(virus_injection, skip_duplicates=True)
-
-    # ExtraCellular recording related tables
-    probe_sources = data.extracellular.probeSource
-    probes = data.extracellular.probeType
-
-    if type(probe_sources) == str:
-        reference.ProbeSource.insert1([probe_sources], skip_duplicates=True)
-        n_channels = int(np.squeeze(re.findall('\s\d{2}', probes)))
-        probe_key = {
-            'probe_type': probes,
-            'probe_source': probe_sources,
-            'channel_counts': n_channels
+            'whisker_config': data.whiskerConfig
         }
-        reference.Probe.insert1(probe_key, skip_duplicates=True)
-    else:
-        for iprobe, probe_source in enumerate(probe_sources):
-            reference.ProbeSource.insert1([probe_source], skip_duplicates=True)
-            probe = probes[iprobe]
-            n_channels = int(np.squeeze(re.findall('\s\d{2}', probe)))
+        action.SubjectWhiskerConfig.insert1(whisker, skip_duplicates=True)
+
+        # virus related tables
+        virus_data = getattr(data, 'virus', None)
+        if virus_data is not None:
+            reference.VirusSource.insert1([virus_data.virusSource],
+                                          skip_duplicates=True)
+            virus = {
+                'virus': virus_data.virusID,
+                'virus_source': virus_data.virusSource
+            }
+            reference.Virus.insert1(virus, skip_duplicates=True)
+
+            location = virus_data.infectionLocation
+            words = re.sub("[^\w]", " ", location).split()
+            hemisphere = next(
+                (word for word in words if word in hemispheres), '')
+            loc = next((word for word in words if word in brain_locations), '')
+            ref = next((word for word in words if word in coordinate_refs), '')
+            virus_injection = {
+                'subject': data.animalID,
+                'virus': virus_data.virusID,
+                'brain_location': loc,
+                'hemisphere': hemisphere,
+                'injection_volume': virus_data.injectionVolume,
+                'injection_date': datetime.strptime(virus_data.injectionDate,
+                                                    '%Y%m%d').date(),
+                'injection_coordinate_ap': virus_data.infectionCoordinates[0],
+                'injection_coordinate_ml': virus_data.infectionCoordinates[1],
+                'injection_coordinate_dv': virus_data.infectionCoordinates[2],
+                'coordinate_ref': ref
+            }
+            action.VirusInjection.insert1(virus_injection,
+                                          skip_duplicates=True)
+
+        # ExtraCellular recording related tables
+        extracellular = data.extracellular
+        probe_sources = extracellular.probeSource
+        probes = extracellular.probeType
+
+        if type(probe_sources) == str:
+            reference.ProbeSource.insert1([probe_sources],
+                                          skip_duplicates=True)
+            n_channels = int(probe_channels_re.findall(probes)[0])
             probe_key = {
-                'probe_type': probe,
-                'probe_source': probe_source,
+                'probe_type': probes,
+                'probe_source': probe_sources,
                 'channel_counts': n_channels
             }
             reference.Probe.insert1(probe_key, skip_duplicates=True)
-            for ich in range(64):
-                reference.Probe.Channel.insert1(
-                    dict(probe_type=probe, channel_id=ich+1),
-                    skip_duplicates=True)
-
-    # ===== acquisition tables ======
-    # Session table and part tables
-    dirs = file.partition('meta_data')
-    session = {
-        'subject': data.animalID,
-        'session_time': datetime.strptime(
-            data.dateOfExperiment+data.timeOfExperiment, '%Y%m%d%H%M%S'),
-        'session_directory': os.path.join(dirs[0], 'data_structure' + dirs[2])
-    }
-    acquisition.Session.insert1(session, skip_duplicates=True)
-
-    session_experimenter = (acquisition.Session & session).fetch('KEY')[0]
-    session_experimenter['experimenter'] = data.experimenters
-    acquisition.Session.Experimenter.insert1(session_experimenter,
-                                             skip_duplicates=True)
-
-    session_type = (acquisition.Session & session).fetch('KEY')[0]
-    if type(data.experimentType) is str:
-        session_type['experment_type'] = data.experimentType
-        acquisition.ExperimentType.insert1([data.experimentType],
-                                           skip_duplicates=True)
-        acquisition.Session.ExperimentType.insert1(session_type,
-                                                   skip_duplicates=True)
-    for exp_type in data.experimentType:
-        session_type['experiment_type'] = exp_type
-        acquisition.ExperimentType.insert1([exp_type], skip_duplicates=True)
-        acquisition.Session.ExperimentType.insert1(session_type,
-                                                   skip_duplicates=True)
-
-    # PhotoStim table
-    photo_stim = (acquisition.Session & session).fetch('KEY')[0]
-    location = data.photostim.photostimLocation
-    words = re.sub("[^\w]", " ", location).split()
-    hemisphere = np.array(words)[np.array(
-        [(word in ['left', 'right']) for word in words])]
-    loc = np.array(words)[np.array(
-        [(word in ['Fastigial', 'Dentate', 'DCN', 'ALM']) for word in words])]
-    photo_stim.update({
-        'photo_stim_wavelength': data.photostim.photostimWavelength,
-        'photo_stim_method': data.photostim.stimulationMethod,
-        'brain_location': str(np.squeeze(loc)),
-        'hemisphere': str(np.squeeze(hemisphere)),
-        'coordinate_ref': 'lambda',
-        'photo_stim_coordinate_ap': data.photostim.photostimCoordinates[0],
-        'photo_stim_coordinate_ml': data.photostim.photostimCoordinates[1],
-        'photo_stim_coordinate_dv': data.photostim.photostimCoordinates[2]
-    })
-    acquisition.PhotoStim.insert1(photo_stim, skip_duplicates=True)
-
-    # ===== ephys tables =====
-    # ProbeInsertion
-    probe_insertion = (acquisition.Session & session).fetch('KEY')[0]
-    probe_type = data.extracellular.probeType
-
-    # to be changed when metadata is fixed
-    if type(probe_type) is not str:
-        probe_type = probe_type[0]
-
-    probe_insertion.update({
-        'probe_type': probe_type,
-        'brain_location': data.extracellular.recordingLocation,
-        'rec_coordinate_ap': data.extracellular.recordingCoordinates[0],
-        'rec_coordinate_ml': data.extracellular.recordingCoordinates[1],
-        'ground_coordinate_ap': data.extracellular.groundCoordinates[0],
-        'ground_coordinate_ml': data.extracellular.groundCoordinates[1],
-        'ground_coordinate_dv': data.extracellular.groundCoordinates[2],
-        'rec_marker': data.extracellular.recordingMarker,
-        'coordinate_ref': 'lambda',
-        'penetration_num': data.extracellular.penetrationN,
-        'spike_sorting_method': data.extracellular.spikeSorting,
-        'ad_unit': data.extracellular.ADunit,
-        'rec_marker': data.extracellular.recordingMarker
-    })
-    ephys.ProbeInsertion.insert1(probe_insertion, skip_duplicates=True)
-
-# populate imported tables
-print('Populating behavior and ephys tables...')
-kargs = dict(
-    display_progress=True,
-    suppress_errors=True
-)
-behavior.TrialSet.populate(**kargs)
-behavior.TrialSetType.populate(**kargs)
-ephys.UnitSpikeTimes.populate(**kargs)
-behavior.TrialNumberSummary.populate(**kargs)
-ephys.UnitSelectivity.populate(**kargs)
-ephys.AlignedPsthStimOn.populate(**kargs)
-ephys.PsthForCodingDirection.populate(**kargs)
-ephys.CodingDirection.populate(**kargs)
-ephys.ProjectedPsthTraining.populate(**kargs)
-ephys.ProjectedPsth.populate(**kargs)
+            reference.Probe.Channel.insert(
+                [dict(probe_type=probes, channel_id=ich+1)
+                 for ich in range(64)], skip_duplicates=True)
+        else:
+            probe_keys = []
+            channels = []
+            for iprobe, probe_source in enumerate(probe_sources):
+                probe = probes[iprobe]
+                n_channels = int(probe_channels_re.findall(probe)[0])
+                probe_keys.append({
+                    'probe_type': probe,
+                    'probe_source': probe_source,
+                    'channel_counts': n_channels
+                })
+                channels.extend(dict(probe_type=probe, channel_id=ich+1)
+                                for ich in range(64))
+            reference.ProbeSource.insert([[probe_source]
+                                          for probe_source in probe_sources],
+                                         skip_duplicates=True)
+            reference.Probe.insert(probe_keys, skip_duplicates=True)
+            reference.Probe.Channel.insert(channels, skip_duplicates=True)
+
+        # ===== acquisition tables ======
+        # Session table and part tables
+        dirs = file.partition('meta_data')
+        session = {
+            'subject': data.animalID,
+            'session_time': datetime.strptime(
+                data.dateOfExperiment+data.timeOfExperiment, '%Y%m%d%H%M%S'),
+            'session_directory': os.path.join(dirs[0],
+                                              'data_structure' + dirs[2])
+        }
+        acquisition.Session.insert1(session, skip_duplicates=True)
+        session_key = (acquisition.Session & session).fetch1('KEY')
+
+        session_experimenter = dict(session_key,
+                                    experimenter=data.experimenters)
+        acquisition.Session.Experimenter.insert1(session_experimenter,
+                                                 skip_duplicates=True)
+
+        exp_types = data.experimentType
+        if type(exp_types) is str:
+            exp_types = [exp_types]
+        acquisition.ExperimentType.insert(
+            [[exp_type] for exp_type in exp_types], skip_duplicates=True)
+        acquisition.Session.ExperimentType.insert(
+            [dict(session_key, experiment_type=exp_type)
+             for exp_type in exp_types], skip_duplicates=True)
+
+        # PhotoStim table
+        photo_stim = session_key.copy()
+        photostim = data.photostim
+        location = photostim.photostimLocation
+        words = re.sub("[^\w]", " ", location).split()
+        hemisphere = next((word for word in words if word in hemispheres), '')
+        loc = next((word for word in words if word in brain_locations), '')
+        photo_stim.update({
+            'photo_stim_wavelength': photostim.photostimWavelength,
+            'photo_stim_method': photostim.stimulationMethod,
+            'brain_location': loc,
+            'hemisphere': hemisphere,
+            'coordinate_ref': 'lambda',
+            'photo_stim_coordinate_ap': photostim.photostimCoordinates[0],
+            'photo_stim_coordinate_ml': photostim.photostimCoordinates[1],
+            'photo_stim_coordinate_dv': photostim.photostimCoordinates[2]
+        })
+        acquisition.PhotoStim.insert1(photo_stim, skip_duplicates=True)
+
+        # ===== ephys tables =====
+        # ProbeInsertion
+        probe_insertion = session_key.copy()
+        probe_type = extracellular.probeType
+
+        # to be changed when metadata is fixed
+        if type(probe_type) is not str:
+            probe_type = probe_type[0]
+
+        probe_insertion.update({
+            'probe_type': probe_type,
+            'brain_location': extracellular.recordingLocation,
+            'rec_coordinate_ap': extracellular.recordingCoordinates[0],
+            'rec_coordinate_ml': extracellular.recordingCoordinates[1],
+            'ground_coordinate_ap': extracellular.groundCoordinates[0],
+            'ground_coordinate_ml': extracellular.groundCoordinates[1],
+            'ground_coordinate_dv': extracellular.groundCoordinates[2],
+            'rec_marker': extracellular.recordingMarker,
+            'coordinate_ref': 'lambda',
+            'penetration_num': extracellular.penetrationN,
+            'spike_sorting_method': extracellular.spikeSorting,
+            'ad_unit': extracellular.ADunit,
+            'rec_marker': extracellular.recordingMarker
+        })
+        ephys.ProbeInsertion.insert1(probe_insertion, skip_duplicates=True)
+
+
+def try_ingest_meta_data(file):
+    # a file that fails is rolled back, reported and skipped, the worker goes
+    # on with the next file on a clean connection
+    try:
+        ingest_meta_data(file)
+    except Exception as e:
+        print('Failed to ingest {}: {!r}'.format(file, e))
+        return file
+
+
+def populate_session(session):
+    # import both tables of a session in the same process, so that the
+    # session file is only parsed once
+    behavior.TrialSet.populate(session, reserve_jobs=True, **kargs)
+    ephys.UnitSpikeTimes.populate(session, reserve_jobs=True, **kargs)
+
+
+def populate_session_units(session):
+    # compute the units of a session in the same process, so that the make
+    # calls of a unit follow each other and share its fetched trials and
+    # spikes
+    ephys.UnitSelectivity.populate(session, reserve_jobs=True, **kargs)
+    ephys.AlignedPsthStimOn.populate(session, reserve_jobs=True, **kargs)
+
+
+if __name__ == '__main__':
+    # insert the meta data
+    print('Ingesting meta data...')
+    files1 = glob.glob('/data/datafiles/meta_data*')
+    files2 = glob.glob('/data/datafiles 2/meta_data*')
+    files = np.hstack([files1, files2])
+
+    # the session files are independent of each other, ingest them in worker
+    # processes; spawned rather than forked, so that each worker opens its own
+    # database connection
+    with multiprocessing.get_context('spawn').Pool(os.cpu_count()) as pool:
+        failed = [file for file in pool.map(try_ingest_meta_data, files)
+                  if file is not None]
+    if failed:
+        print('Skipped {} meta data file(s) that failed to ingest:'.format(
+            len(failed)))
+        for file in failed:
+            print('  {}'.format(file))
+
+    # populate imported tables
+    print('Populating behavior and ephys tables...')
+    # sessions are imported in parallel, one session per worker at a time
+    with multiprocessing.get_context('spawn').Pool(os.cpu_count()) as pool:
+        pool.map(populate_session, acquisition.Session.fetch('KEY'),
+                 chunksize=1)
+    behavior.TrialSetType.populate(**kargs)
+    behavior.TrialNumberSummary.populate(**kargs)
+    # sessions are independent of each other, spread them over worker
+    # processes
+    with multiprocessing.get_context('spawn').Pool(os.cpu_count()) as pool:
+        pool.map(populate_session_units, acquisition.Session.fetch('KEY'),
+                 chunksize=1)
+    ephys.PsthForCodingDirection.populate(**kargs)
+    ephys.CodingDirection.populate(**kargs)
+    ephys.ProjectedPsthTraining.populate(**kargs)
+    ephys.ProjectedPsth.populate(**kargs)
@@ -11,6 +11,6 @@ setup(
     author='Vathes',
     author_email='support@vathes.com',
     packages=find_packages(exclude=[]),
-    install_requires=['datajoint>=0.12', 'pynwb'],
+    install_requires=['datajoint>=0.12', 'pynwb', 'h5py'],
     scripts=['scripts/gao2018-shell.py'],
 )